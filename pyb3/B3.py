@@ -22,14 +22,11 @@
 # SOFTWARE.
 # ###############################################################################
 
-import astropy.time
 import json
+import struct
+import numpy as np
 from datetime import datetime
-from .outputter import Equinox
-
-
-# ----------------------------------------- EPOCH -----------------------------------------
-ds50epoch = astropy.time.Time( datetime.strptime( '1949-12-31T00:00:00', "%Y-%m-%dT%H:%M:%S") )
+from .outputter import Equinox, ds50Day
 
 
 # these fields are pulled out of the AstroStandards code and pushed into JSON
@@ -39,6 +36,9 @@ as_fields = json.loads('["XA_OBS_ASTAT", "XA_OBS_AZORRA", "XA_OBS_AZRATE", "XA_O
 # classification map (astrostandards stores the classification as a number)
 classmap = {'U':1.0, 'C':2.0, 'S':3.0}
 
+# structured array version of the astrostandards dict (one record per ob)
+ASTRO_DTYPE = np.dtype( [ (f, np.float64) for f in as_fields ] )
+
 # float map
 charmap = {
     'J' : '-1',
@@ -52,6 +52,77 @@ charmap = {
     'R' : '-9'
 }
 
+# which obstypes carry which fields
+_HAS_EL    = frozenset((1,2,3,4,5,8,9))
+_HAS_AZ    = frozenset((1,2,3,4,8))
+_HAS_RA    = frozenset((5,9))
+_HAS_ECF   = frozenset((8,9))
+_HAS_RANGE = frozenset((2,3,4,6))
+_HAS_RRATE = frozenset((3,4,0))
+
+# equinox column
+_EQUINOX = {' ' : Equinox.TEME,
+            '0' : Equinox.TEME,
+            '1' : Equinox.MEME,
+            '2' : Equinox.J2K,
+            '3' : Equinox.B1950}
+
+def _datetime_to_ds50( dt ):
+    '''
+    days-since-1950 (UTC) from a datetime, with integer day arithmetic (see ds50Day)
+    instead of building an astropy Time per record
+    every day is taken as 86400 s: on a leap-second day astropy.time.Time( dt ).jd
+    stretches the day, so the two differ there by up to ~6.5e-6 day (~0.5 s);
+    elsewhere they agree to ~1e-9 day
+    '''
+    secs = dt.hour * 3600 + dt.minute * 60 + dt.second + dt.microsecond * 1e-6
+    return ds50Day( dt.year, dt.timetuple().tm_yday ) + secs / 86400.
+
+# common leading fields of a B3 card: class, satid, sensor, YY, DDD, HH, MM, SS, mmm (columns 0-22)
+_B3_STRUCT = struct.Struct( '1s5s3s2s3s2s2s2s3s' )
+
+# ----------------------------------------- BULK PARSING -----------------------------------------
+# widest column we look at (site tag / spadoc tag run past the 80 char card)
+_B3_WIDTH = 90
+
+# the leading character of the el/dec field carries the sign and the first digit (see charmap)
+_lead_sign  = np.ones( 256, dtype=np.float64 )
+_lead_digit = np.zeros( 256, dtype=np.float64 )
+_lead_sign[ ord('-') ] = -1.
+for _c in '0123456789': _lead_digit[ ord(_c) ] = int(_c)
+for _c, _v in charmap.items():
+    _lead_sign[ ord(_c) ]  = -1.
+    _lead_digit[ ord(_c) ] = int( _v[1] )
+
+def _char_matrix( lines ):
+    '''
+    stack the lines into an (N, _B3_WIDTH) uint8 matrix, space padded
+    '''
+    # non-ascii characters become '?', so they only spoil the field they sit in
+    buf = b''.join( l[:_B3_WIDTH].encode('ascii', 'replace').ljust(_B3_WIDTH) for l in lines )
+    return np.frombuffer( buf, dtype=np.uint8 ).reshape( -1, _B3_WIDTH )
+
+def _column( mat, a, b ):
+    ''' fixed-width column [a:b] of every line as an (N,) bytes array '''
+    return np.ascontiguousarray( mat[:, a:b] ).view( 'S{}'.format(b-a) ).ravel()
+
+def _int_column( mat, a, b ):
+    return _column( mat, a, b ).astype( np.int64 )
+
+def _float_column( mat, a, b ):
+    '''
+    float parse of a column, NaN wherever the field is blank or will not parse
+    '''
+    col = np.char.strip( _column( mat, a, b ) )
+    out = np.full( col.shape, np.nan )
+    ok  = col != b''
+    try: out[ok] = col[ok].astype( np.float64 )
+    except ValueError:
+        for i in np.flatnonzero( ok ):
+            try: out[i] = float( col[i] )
+            except ValueError: pass
+    return out
+
 # -----------------------------------------------------------------------------------------------------
 class B3:
     jd1950 = 2433281.5
@@ -77,23 +148,24 @@ class B3:
 
     def parse( self, L ):
         # common fields
-        self.classification = L[0]
-        self.satid   = int( L[1:6] )
-        self.sensid  = int( L[6:9] )
-        self.year    = int( L[9:11] )
+        cls_, sat, sen, yy, doy, hh, mm, ss, mil = _B3_STRUCT.unpack_from( L[:23].encode('ascii') )
+        self.classification = cls_.decode('ascii')
+        self.satid   = int( sat )
+        self.sensid  = int( sen )
+        self.year    = int( yy )
         if self.year < 50 : self.year += 2000
         else: self.year += 1900
-        self.doy     = int( L[11:14] )
-        self.hour    = int( L[14:16] )
-        self.minute  = int( L[16:18] )
-        self.second  = int( L[18:20] )
-        self.millis  = int( L[20:23])
+        self.doy     = int( doy )
+        self.hour    = int( hh )
+        self.minute  = int( mm )
+        self.second  = int( ss )
+        self.millis  = int( mil )
         self.alldate = L[9:23]
 
         self.obstype = int( L[74] )
 
         # elevation or declination
-        if self.obstype in set([1,2,3,4,5,8,9]):
+        if self.obstype in _HAS_EL:
             # deal with the char mapping
             poschar = L[23]
             prefix  = L[23]
@@ -103,8 +175,8 @@ class B3:
 
         # azimuth or right ascension
         self.azra = 0.
-        if self.obstype in set([1,2,3,4,8]): self.azra = float( L[30:37] ) / 10000
-        if self.obstype in set([5,9]): 
+        if self.obstype in _HAS_AZ: self.azra = float( L[30:37] ) / 10000
+        if self.obstype in _HAS_RA:
             self.azra = float(L[30:32]) + float(L[32:34])/60. + float(L[34:37])/36000
             self.azra *= 360./24.
 
@@ -115,31 +187,29 @@ class B3:
         except: self.range = self.default
 
         # other types of obs
-        if self.obstype in set([8,9]):
-            self.rngrate = 0.
+        # (types 8/9 carry the ECF position in the rate columns, so don't read rates from them)
+        if self.obstype in _HAS_ECF:
             self.ecfx    = float(L[46:55]) / 1000.
             self.ecfy    = float(L[55:64]) / 1000.
             self.ecfz    = float(L[64:73]) / 1000.
+            self.rngrate = 0.
+            self.elrate = self.azrate = self.rangeacc = self.default
         else: 
             self.ecfx = self.ecfy = self.ecfz = 0.
 
-        try: self.rngrate = float(L[47:54]) / 100000.
-        except: self.rngrate = self.default
+            try: self.rngrate = float(L[47:54]) / 100000.
+            except: self.rngrate = self.default
 
-        try: self.elrate = float(L[55:60]) / 10000
-        except: self.elrate = self.default
+            try: self.elrate = float(L[55:60]) / 10000
+            except: self.elrate = self.default
 
-        try: self.azrate = float(L[61:66]) / 10000
-        except: self.azrate = self.default
+            try: self.azrate = float(L[61:66]) / 10000
+            except: self.azrate = self.default
 
-        try: self.rangeacc = float( L[67:72] ) / 10000 
-        except: self.rangeacc = self.default
+            try: self.rangeacc = float( L[67:72] ) / 10000 
+            except: self.rangeacc = self.default
 
-        self.equinox = None
-        if L[75] == ' ' or L[75] == '0' : self.equinox = Equinox.TEME
-        if L[75] == '1' : self.equinox = Equinox.MEME
-        if L[75] == '2' : self.equinox = Equinox.J2K
-        if L[75] == '3' : self.equinox = Equinox.B1950
+        self.equinox = _EQUINOX.get( L[75] )
 
 
         try: self.track_position = int( L[76] )
@@ -187,18 +257,18 @@ class B3:
         rv = {}
         for v in as_fields: rv[v] = 0.0
         rv['XA_OBS_SECCLASS'] = classmap[ self.classification ]
-        rv['XA_OBS_DS50UTC'] = astropy.time.Time( self.datetime ).jd - self.jd1950
+        rv['XA_OBS_DS50UTC'] = _datetime_to_ds50( self.datetime )
         rv['XA_OBS_SATNUM']  = self.satid
         rv['XA_OBS_OBSTYPE'] = self.obstype
         rv['XA_OBS_SENNUM']  = self.sensid
-        if self.obstype in set([1,2,3,4,5,8,9]): rv['XA_OBS_ELORDEC'] = self.eledec
-        if self.obstype in set([1,2,3,4,5,8,9] ): rv['XA_OBS_AZORRA'] = self.azra
-        if self.obstype in set([2,3,4,6]) : rv['XA_OBS_RANGE'] = self.range
-        if self.obstype in set([3,4,0]) : rv['XA_OBS_RANGERATE'] = self.rngrate
+        if self.obstype in _HAS_EL:    rv['XA_OBS_ELORDEC'] = self.eledec
+        if self.obstype in _HAS_EL:    rv['XA_OBS_AZORRA'] = self.azra
+        if self.obstype in _HAS_RANGE: rv['XA_OBS_RANGE'] = self.range
+        if self.obstype in _HAS_RRATE: rv['XA_OBS_RANGERATE'] = self.rngrate
         if self.obstype == 4:
             rv['XA_OBS_AZRATE'] = self.azrate
             rv['XA_OBS_ELRATE'] = self.elrate
-        if self.obstype in set([8,9]):
+        if self.obstype in _HAS_ECF:
             rv['XA_OBS_POSX'] = self.ecfx
             rv['XA_OBS_POSY'] = self.ecfy
             rv['XA_OBS_POSZ'] = self.ecfz
@@ -218,6 +288,169 @@ class B3:
     def toB3( self ):
         return outputter.b3_dispatcher( self.toAstrostdDict() )
 
+    @classmethod
+    def parse_many( cls, lines ):
+        '''
+        bulk version of parse: slice every fixed-width column of all the lines at once
+        and return a dict of arrays (one entry per B3 attribute, indexed by line)
+        use B3View to get at a single record with the usual B3 interface
+        '''
+        lines = list( lines )
+        mat   = _char_matrix( lines )
+        default = -1.0
+
+        soa = {'origline' : np.array( lines, dtype=object ) }
+        soa['classification'] = _column( mat, 0, 1 ).astype( str )
+        soa['satid']   = _int_column( mat, 1, 6 )
+        soa['sensid']  = _int_column( mat, 6, 9 )
+        year = _int_column( mat, 9, 11 )
+        soa['year']    = np.where( year < 50, year + 2000, year + 1900 )
+        soa['doy']     = _int_column( mat, 11, 14 )
+        soa['hour']    = _int_column( mat, 14, 16 )
+        soa['minute']  = _int_column( mat, 16, 18 )
+        soa['second']  = _int_column( mat, 18, 20 )
+        soa['millis']  = _int_column( mat, 20, 23 )
+        soa['alldate'] = _column( mat, 9, 23 ).astype( str )
+        obstype = soa['obstype'] = _int_column( mat, 74, 75 )
+
+        # elevation or declination
+        lead = mat[:, 23]
+        eledec = _lead_sign[lead] * (_lead_digit[lead] * 100000 + _float_column( mat, 24, 29 )) / 10000.
+        soa['eledec'] = np.where( np.isin( obstype, list(_HAS_EL) ), eledec, np.nan )
+
+        # azimuth or right ascension
+        azra = np.zeros( len(lines) )
+        isaz = np.isin( obstype, list(_HAS_AZ) )
+        azra[isaz] = _float_column( mat, 30, 37 )[isaz] / 10000
+        isra = np.isin( obstype, list(_HAS_RA) )
+        ra   = _float_column( mat, 30, 32 ) + _float_column( mat, 32, 34 )/60. + _float_column( mat, 34, 37 )/36000
+        azra[isra] = ra[isra] * 360./24.
+        soa['azra'] = azra
+
+        rgexp = np.nan_to_num( _float_column( mat, 45, 46 ), nan=default )
+        soa['rgexp'] = rgexp
+        soa['range'] = np.nan_to_num( (_float_column( mat, 38, 45 ) / 100000) * (10 ** rgexp), nan=default )
+
+        # other types of obs
+        isecf = np.isin( obstype, list(_HAS_ECF) )
+        for name, a, b in (('ecfx', 46, 55), ('ecfy', 55, 64), ('ecfz', 64, 73)):
+            soa[name] = np.where( isecf, _float_column( mat, a, b ) / 1000., 0. )
+
+        rngrate = np.nan_to_num( _float_column( mat, 47, 54 ) / 100000., nan=default )
+        soa['rngrate']  = np.where( isecf, 0., rngrate )
+        for name, a, b in (('elrate', 55, 60), ('azrate', 61, 66), ('rangeacc', 67, 72)):
+            soa[name] = np.where( isecf, default, np.nan_to_num( _float_column( mat, a, b ) / 10000, nan=default ) )
+
+        soa['equinox'] = np.array( [ _EQUINOX.get( c, '' ) for c in _column( mat, 75, 76 ).astype( str ) ] )
+
+        # optional integer fields (NaN when missing)
+        soa['track_position'] = _float_column( mat, 76, 77 )
+        soa['astat']          = _float_column( mat, 79, 80 )
+        soa['site_tag']       = _float_column( mat, 80, 85 )
+        soa['spadoc_tag']     = _float_column( mat, 85, 90 )
+        return soa
+
+
+# -----------------------------------------------------------------------------------------------------
+class B3View( B3 ):
+    '''
+    a single record of the dict-of-arrays returned by B3.parse_many, with the same interface as B3
+    '''
+    _optional = frozenset(('track_position', 'astat', 'site_tag', 'spadoc_tag'))
+
+    def __init__( self, soa, idx ):
+        self.default  = -1.0
+        self.soa      = soa
+        self.idx      = idx
+        self.origline = soa['origline'][idx]
+
+    def __getattr__( self, name ):
+        if name == 'datetime': return self.setdate()
+        if name in ('soa', 'idx') or name not in self.soa: raise AttributeError( name )
+        val = self.soa[name][self.idx]
+        if name == 'equinox': return str(val) if val else None
+        if name in self._optional: return None if np.isnan(val) else int(val)
+        return val.item() if isinstance( val, np.generic ) else val
+
+    @classmethod
+    def from_lines( cls, lines ):
+        soa = cls.parse_many( lines )
+        return [ cls( soa, i ) for i in range( len(soa['origline']) ) ]
+
+
+# -----------------------------------------------------------------------------------------------------
+class B3Batch:
+    '''
+    struct-of-arrays container for many B3 records: every B3 attribute is an array column
+    (see B3.parse_many), indexing gives back a B3View
+    '''
+    def __init__( self, soa ):
+        self.soa = soa
+        for k, v in soa.items(): setattr( self, k, v )
+
+    @classmethod
+    def from_lines( cls, lines ):
+        return cls( B3.parse_many( lines ) )
+
+    def __len__( self ):
+        return len( self.origline )
+
+    def __getitem__( self, idx ):
+        return B3View( self.soa, idx )
+
+    def ds50( self ):
+        '''
+        days-since-1950 for every record, same date convention as B3.setdate
+        '''
+        # B3.setdate left-justifies the millis digits into the microsecond field
+        millis = self.millis
+        digits = np.where( millis >= 100, 3, np.where( millis >= 10, 2, 1 ) )
+        micros = millis * 10 ** (6 - digits)
+        secs   = self.hour * 3600 + self.minute * 60 + self.second + micros * 1e-6
+        return ds50Day( self.year, self.doy ) + secs / 86400.
+
+    def toAstrostdArray( self ):
+        return to_astro_std_array( self )
+
+
+def to_astro_std_array( batch ):
+    '''
+    bulk B3.toAstrostdDict: an (N,) structured array (ASTRO_DTYPE) with one record per ob
+    '''
+    out = np.zeros( len(batch), dtype=ASTRO_DTYPE )
+    obstype = batch.obstype
+    # unmapped classifications are an error, as in B3.toAstrostdDict
+    known = np.isin( batch.classification, list(classmap) )
+    if not known.all():
+        raise KeyError( 'unknown classification {}'.format( sorted( set( batch.classification[~known] ) ) ) )
+    for c, v in classmap.items(): out['XA_OBS_SECCLASS'][ batch.classification == c ] = v
+    out['XA_OBS_DS50UTC'] = batch.ds50()
+    out['XA_OBS_SATNUM']  = batch.satid
+    out['XA_OBS_OBSTYPE'] = obstype
+    out['XA_OBS_SENNUM']  = batch.sensid
+
+    mask = np.isin( obstype, list(_HAS_EL) )
+    out['XA_OBS_ELORDEC'][mask] = batch.eledec[mask]
+    out['XA_OBS_AZORRA'][mask]  = batch.azra[mask]
+    mask = np.isin( obstype, list(_HAS_RANGE) )
+    out['XA_OBS_RANGE'][mask] = batch.range[mask]
+    mask = np.isin( obstype, list(_HAS_RRATE) )
+    out['XA_OBS_RANGERATE'][mask] = batch.rngrate[mask]
+    mask = obstype == 4
+    out['XA_OBS_AZRATE'][mask] = batch.azrate[mask]
+    out['XA_OBS_ELRATE'][mask] = batch.elrate[mask]
+    mask = np.isin( obstype, list(_HAS_ECF) )
+    out['XA_OBS_POSX'][mask] = batch.ecfx[mask]
+    out['XA_OBS_POSY'][mask] = batch.ecfy[mask]
+    out['XA_OBS_POSZ'][mask] = batch.ecfz[mask]
+
+    # optional fields are NaN when missing
+    out['XA_OBS_SITETAG']   = np.nan_to_num( batch.site_tag )
+    out['XA_OBS_SPADOCTAG'] = np.nan_to_num( batch.spadoc_tag )
+    out['XA_OBS_TRACKIND']  = np.nan_to_num( batch.track_position )
+    out['XA_OBS_ASTAT']     = np.nan_to_num( batch.astat )
+    return out
+
 
 
 # =====================================================================================================
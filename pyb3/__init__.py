@@ -1 +1 @@
-from .B3 import B3
+from .B3 import B3, B3View, B3Batch
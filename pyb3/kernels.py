@@ -0,0 +1,175 @@
+# ###############################################################################
+# MIT License
+#
+# Copyright (c) 2023 Kerry Wood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ###############################################################################
+
+'''
+ASCII kernels for bulk B3 output: the same fields as the string writers in outputter.py,
+but written straight into a uint8 buffer so they can be compiled with numba.
+without numba installed these still work (as plain python), just slowly -- use the
+per-line outputter.b3_dispatcher in that case.
+'''
+
+import math
+import numpy as np
+from .outputter import Equinox, ds50Day
+
+try:
+    import numba
+    njit = numba.njit( cache=True )
+except ImportError:
+    numba = None
+    def njit( fn ): return fn
+
+# line length (75 chars + equinox) plus the newline
+LINE_LEN = 77
+
+_ds50Day = njit( ds50Day )
+
+# B3 negative fields: leading digit replaced by a character (see outputter._NEG_PREFIX)
+_NEG = np.array( [ ord(c) for c in '-JKLMNOPQR' ], dtype=np.uint8 )
+
+# ----------------------------------------- FIELD KERNELS -----------------------------------------
+@njit
+def _write_int( out, off, val, width ):
+    ''' zero padded integer, truncated to the last `width` digits '''
+    for i in range( width - 1, -1, -1 ):
+        out[off + i] = 48 + val % 10
+        val //= 10
+
+@njit
+def B3_float_field( out, off, val, left, right ):
+    '''
+    kernel version of outputter.B3_float_field: decimal implied between the left/right digits,
+    negatives carry the sign in the leading character
+    '''
+    n = int( round( abs(val) * 10.**right ) )
+    _write_int( out, off, n, left + right )
+    if val < 0: out[off] = _NEG[ out[off] - 48 ]
+
+@njit
+def makeRange( out, off, rangeval ):
+    '''
+    kernel version of outputter.makeRange: 7 significant digits at [off, off+7), exponent at off+7
+    '''
+    exp    = int( math.log10( rangeval ) )
+    expval = exp - 1
+    if expval < 0 or expval > 9: raise ValueError('cannot set range exponent')
+    _write_int( out, off, int( rangeval * 10.**(6 - exp) * (1 + 1e-12) ), 7 )
+    out[off + 7] = 48 + expval
+
+@njit
+def makeRA( out, off, ra ):
+    ''' kernel version of outputter.makeRA: HHMMSSS (tenths of seconds) '''
+    ra     = (ra + 360) % 360
+    hours  = int( ra / 15 )
+    frac   = ra - (15 * hours)
+    minut  = int( frac / 0.25 )
+    frac  -= 0.25 * minut
+    tenths = int( round( frac * 864000./360. ) )
+    _write_int( out, off, hours, 2 )
+    _write_int( out, off + 2, minut, 2 )
+    _write_int( out, off + 4, tenths, 3 )
+
+@njit
+def fortran9p3( out, off, flt ):
+    ''' kernel version of outputter.fortran9p3: sign + 5.3 digits '''
+    out[off] = 45 if flt < 0 else 43
+    _write_int( out, off + 1, int( abs(flt) * 1000. + 1e-6 ), 8 )
+
+@njit
+def makeDate( out, off, ds50 ):
+    '''
+    YYDDDHHMMSSmmm from days-since-1950 (day 1.0 == 1950-01-01T00:00)
+    '''
+    micros = int( round( ds50 * 86400e6 ) )
+    days   = micros // 86400000000
+    micros = micros - days * 86400000000
+    # days since 0000-03-01 (proleptic gregorian), then back out the civil year
+    z    = days + 712162
+    era  = z // 146097
+    doe  = z - era * 146097
+    yoe  = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy  = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp   = (5 * doy + 2) // 153
+    year = yoe + era * 400 + (1 if mp >= 10 else 0)
+    _write_int( out, off, year % 100, 2 )
+    _write_int( out, off + 2, days - _ds50Day( year, 1 ) + 1, 3 )
+    _write_int( out, off + 5, micros // 3600000000, 2 )
+    _write_int( out, off + 7, (micros // 60000000) % 60, 2 )
+    _write_int( out, off + 9, (micros // 1000000) % 60, 2 )
+    _write_int( out, off + 11, (micros // 1000) % 1000, 3 )
+
+# ----------------------------------------- LINE DRIVER -----------------------------------------
+@njit
+def _write_lines( satnum, sennum, ds50, obstype, eldec, azra, rng, rngrate,
+                  elrate, azrate, rngaccel, posx, posy, posz, equinox, out ):
+    for i in range( satnum.shape[0] ):
+        off = i * LINE_LEN
+        for j in range( LINE_LEN - 1 ): out[off + j] = 32
+        out[off + LINE_LEN - 1] = 10
+        ot = int( obstype[i] )
+        if ot != 1 and ot != 2 and ot != 3 and ot != 4 and ot != 5 and ot != 6 and ot != 9: continue
+        out[off] = 85  # 'U'
+        _write_int( out, off + 1, int( satnum[i] ), 5 )
+        _write_int( out, off + 6, int( sennum[i] ), 3 )
+        makeDate( out, off + 9, ds50[i] )
+        if ot != 6:
+            B3_float_field( out, off + 23, eldec[i], 2, 4 )
+            if ot == 5 or ot == 9: makeRA( out, off + 30, azra[i] )
+            else: B3_float_field( out, off + 30, azra[i], 3, 4 )
+        if ot == 2 or ot == 3 or ot == 4 or ot == 6:
+            makeRange( out, off + 38, rng[i] )
+        if ot == 3 or ot == 4:
+            B3_float_field( out, off + 47, rngrate[i], 2, 5 )
+        if ot == 4:
+            B3_float_field( out, off + 55, elrate[i], 1, 4 )
+            B3_float_field( out, off + 61, azrate[i], 1, 4 )
+            B3_float_field( out, off + 67, rngaccel[i], 1, 4 )
+        if ot == 9:
+            for j in range( 7 ): out[off + 38 + j] = 48
+            fortran9p3( out, off + 46, posx[i] )
+            fortran9p3( out, off + 55, posy[i] )
+            fortran9p3( out, off + 64, posz[i] )
+        out[off + 74] = 48 + ot
+        out[off + 75] = equinox
+
+def write_b3_lines( obdata_soa, out_buf=None, equinox=Equinox.TEME ):
+    '''
+    bulk B3 output: obdata_soa maps the XA_OBS_* names to arrays (one entry per ob),
+    each line (plus newline) is written into out_buf, a contiguous uint8 array of exactly
+    N * LINE_LEN bytes (allocated if not given). obstypes the dispatcher can't write are left as blank lines.
+    '''
+    assert len(equinox) == 1
+    cols = [ np.ascontiguousarray( obdata_soa[k], dtype=np.float64 ) for k in
+                ('XA_OBS_SATNUM', 'XA_OBS_SENNUM', 'XA_OBS_DS50UTC', 'XA_OBS_OBSTYPE',
+                 'XA_OBS_ELORDEC', 'XA_OBS_AZORRA', 'XA_OBS_RANGE', 'XA_OBS_RANGERATE',
+                 'XA_OBS_ELRATE', 'XA_OBS_AZRATE', 'XA_OBS_RANGEACCEL',
+                 'XA_OBS_POSX', 'XA_OBS_POSY', 'XA_OBS_POSZ') ]
+    nbytes = len(cols[0]) * LINE_LEN
+    if out_buf is None: out_buf = np.empty( nbytes, dtype=np.uint8 )
+    # the compiled kernel doesn't bounds check, so make sure everything fits
+    if not isinstance( out_buf, np.ndarray ) or out_buf.dtype != np.uint8 or out_buf.ndim != 1 \
+            or not out_buf.flags['C_CONTIGUOUS'] or out_buf.shape[0] != nbytes:
+        raise ValueError( 'write_b3_lines: out_buf must be a contiguous 1-d uint8 array of exactly {} bytes'.format( nbytes ) )
+    _write_lines( *cols, ord(equinox), out_buf )
+    return out_buf
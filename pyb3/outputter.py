@@ -28,8 +28,9 @@ import sys
 import astropy.coordinates
 import astropy.units as u
 import astropy.time
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import json
+import math
 import numpy as np
 
 # ----------------------------------------- EPOCH -----------------------------------------
@@ -46,6 +47,17 @@ class EqVals:
 Equinox = EqVals
 # ----------------------------------------- EQUINOX -----------------------------------------
 
+# B3 negative fields: the leading digit is replaced by a character so the field length doesn't change
+_NEG_PREFIX = {'0':'-', '1':'J', '2':'K', '3':'L', '4':'M', '5':'N', '6':'O', '7':'P', '8':'Q', '9':'R'}
+
+def ds50Day( year, doy ):
+    '''
+    days-since-1950 at 00:00 of day-of-year doy (1950-01-01 is 1.0)
+    integer arithmetic only, so this works on scalars, numpy arrays and under numba
+    '''
+    y1 = year - 1
+    return 365 * y1 + y1 // 4 - y1 // 100 + y1 // 400 - 711856 + doy - 1
+
 def ds50ToATime( flt ):
     #try: return ds50dt + timedelta( days=flt )
     try: return astropy.time.Time( ds50epoch.jd + flt , format='jd' )
@@ -58,9 +70,22 @@ def ds50ToDateTime( flt ):
     '''
     given the days-since-1950 float, return a datetime
      "YYDDDHHMMSS.SSS"
+    plain datetime arithmetic (use ds50ToATime if you need an astropy Time);
+    rounded to the microsecond so float drift doesn't leak into the seconds field
      '''
-    return ds50ToATime( flt ).datetime
-    #return ds50ToATime( flt )
+    return ds50dt + timedelta( microseconds=round( float(flt) * 86400e6 ) )
+
+def ds50ToDateTime_batch( arr, leapseconds=False ):
+    '''
+    vectorized ds50ToDateTime: array of days-since-1950 floats to an array of datetimes
+    (one numpy conversion instead of N timedelta adds)
+    leapseconds=True goes through a single astropy UTC Time instead (same answer as ds50ToATime)
+    '''
+    if leapseconds:
+        jd = ds50epoch.jd + np.asarray( arr, dtype=np.float64 )
+        return astropy.time.Time( jd, format='jd', scale='utc' ).to_datetime()
+    micros = np.round( np.asarray( arr, dtype=np.float64 ) * 86400e6 ).astype( 'timedelta64[us]' )
+    return ( np.datetime64( ds50dt, 'us' ) + micros ).astype( object )
 
 
 def B3_float_field( val, left, right ):
@@ -68,40 +93,34 @@ def B3_float_field( val, left, right ):
     given a float, we need a structured output that puts the decimal at a specific column
     total field length = left + right
     further, B3's deal with negatives with a character mapping to keep the field-lengths constant (see below)
+    the value is rounded to the nearest last digit (same integer arithmetic as kernels.B3_float_field)
     '''
-    if val < 0: neg = True
-    else: neg = False
-    val = np.round( np.abs(val), right )
-    #l,r = str(np.abs(val)).split('.')
-    # KNW: fixed thanks to SJH on 2021/07/20
-    l,r = '{:.20f}'.format( np.abs(val) ).split('.')
-    l = l[-left:].rjust(left,'0')
-    r = r[:right].ljust(right,'0')
-    if not neg: return l + r
-    if l[0] == '0' : return '-' + l[1:] + r
-    if l[0] == '1' : return 'J' + l[1:] + r
-    if l[0] == '2' : return 'K' + l[1:] + r
-    if l[0] == '3' : return 'L' + l[1:] + r
-    if l[0] == '4' : return 'M' + l[1:] + r
-    if l[0] == '5' : return 'N' + l[1:] + r
-    if l[0] == '6' : return 'O' + l[1:] + r
-    if l[0] == '7' : return 'P' + l[1:] + r
-    if l[0] == '8' : return 'Q' + l[1:] + r
-    if l[0] == '9' : return 'R' + l[1:] + r
-
-def makeDate( datetm ): return datetm.strftime('%y%j%H%M%S%f')[:14]
+    width = left + right
+    f = f'{int( round( abs(val) * 10.**right ) ):0{width}d}'[-width:]
+    if val < 0: return _NEG_PREFIX[ f[0] ] + f[1:]
+    return f
 
-def makeCommon( obdata, datetm=None, classification='U' ):
-    ts      = list(' '*75)  # init the string (without epoch setting // will add later)
-    ts[0]   = 'U'
-    ts[1:6] = '{:05d}'.format( int(obdata['XA_OBS_SATNUM'] ) )
-    ts[6:9] = '{:03d}'.format( int(obdata['XA_OBS_SENNUM'] ) )
+def makeDate( datetm ):
+    '''
+    YYDDDHHMMSSmmm (same as strftime('%y%j%H%M%S%f')[:14], without the strftime)
+    '''
+    doy = datetm.toordinal() - date( datetm.year, 1, 1 ).toordinal() + 1
+    return f'{datetm.year % 100:02d}{doy:03d}{datetm.hour:02d}{datetm.minute:02d}{datetm.second:02d}{datetm.microsecond // 1000:03d}'
+
+def _write_common( out, off, obdata, datetm=None ):
+    '''
+    class, sat, sensor and date fields into out[off:off+23]
+    '''
+    out[off:off+1]    = b'U'
+    out[off+1:off+6]  = f"{int(obdata['XA_OBS_SATNUM']):05d}".encode('ascii')
+    out[off+6:off+9]  = f"{int(obdata['XA_OBS_SENNUM']):03d}".encode('ascii')
     # we can pass in a datetime, or use what's in the struct (mostly this will be used for non A.S. data)
-    if datetm == None:
-        timedatetime = ds50ToDateTime( obdata['XA_OBS_DS50UTC'])
-        ts[9:23] = makeDate( timedatetime )
-    else:
-        ts[9:23] = makeDate( datetm )
+    if datetm == None: datetm = ds50ToDateTime( obdata['XA_OBS_DS50UTC'])
+    out[off+9:off+23] = makeDate( datetm ).encode('ascii')
+
+def makeCommon( obdata, datetm=None, classification='U' ):
+    ts      = bytearray(b' '*75)  # init the line (without epoch setting // will add later)
+    _write_common( ts, 0, obdata, datetm=datetm )
     return ts
 
 def makeEl( el ): return B3_float_field( el, 2, 4)
@@ -117,45 +136,51 @@ def makeRA( dec ):
     frac   = dec - (15 * hours)
     minut  = int( frac / 0.25 )
     frac -= 0.25 * minut 
-    secs   =  frac * 86400./360.
-    secsS  = '{:04.1f}'.format( secs ).replace('.','')
-    frac -= secs * 0.25/60
-    return "{:02d}{:02d}{}".format( hours, minut, secsS )
+    tenths = int( round( frac * 864000./360. ) )  # seconds, to a tenth
+    return f'{hours:02d}{minut:02d}{tenths:03d}'
 
 def makeRange( rangeval ):
     '''
     return the range field and the exponent location
     '''
-    exp = int(np.log10( rangeval ))
+    exp = int(math.log10( rangeval ))
     expval = exp-1  # this is the exponent mapping (valid ranges are 99.99999 to 9,999,999, so 0=10^1)
     #if expval < 0 or expval > 5: 
     # KNW : changed to 9 because of one outlier
     if expval < 0 or expval > 9: 
         raise Exception('cannot set exponent, value is {} -- range {}'.format( expval,rangeval ) )
-    return str(rangeval).replace('.','').ljust(7,'0')[0:7], str(expval)
+    # first 7 significant digits (the tiny scale-up keeps e.g. 22063.24 from flooring to ...23)
+    return f'{int( rangeval * 10.**(6 - exp) * (1 + 1e-12) ):07d}'[-7:], str(expval)
 
 def fortran9p3( flt ): 
     '''
     this is used for type 9 EFG sensor locations
     '''
-    if flt < 0: neg = True
-    else : neg = False
-    l,r = str(np.abs(flt)).split('.')
-    l = l[-6:].rjust(6,'0')
-    r = r[:3].ljust(3,'0')
-    if neg : return '-' + l[1:] + r
-    return '+' + l[1:] + r
+    sign = '-' if flt < 0 else '+'
+    return sign + f'{int( abs(flt) * 1000. + 1e-6 ):08d}'[-8:]
 
+# the _write_typeN functions fill the type-specific columns of a line starting at out[off],
+# the maketypeN functions wrap them for a single line
 # ------------------------------------  TYPE 1 ---------------------------------------
+def _write_type1( out, off, obdata ):
+    out[off+23:off+29] = makeEl( obdata['XA_OBS_ELORDEC']).encode('ascii')
+    out[off+30:off+37] = B3_float_field( obdata['XA_OBS_AZORRA'], 3,4).encode('ascii')
+    out[off+74:off+75] = b'1'
+
 def maketype1( obdata, datetm=None ):
     ts = makeCommon( obdata, datetm=datetm )
-    ts[23:29] = makeEl( obdata['XA_OBS_ELORDEC'])
-    ts[30:37] = B3_float_field( obdata['XA_OBS_AZORRA'], 3,4)
-    ts[74] = '1'
-    #ts[75] = '0'
-    return ''.join(ts)
+    _write_type1( ts, 0, obdata )
+    return ts.decode('ascii')
 
 # ------------------------------------  TYPE 2 ---------------------------------------
+def _write_type2( out, off, data ):
+    out[off+23:off+29] = makeEl( data['XA_OBS_ELORDEC']).encode('ascii')
+    out[off+30:off+37] = B3_float_field( data['XA_OBS_AZORRA'],3,4).encode('ascii')
+    rgval, rgexp = makeRange(data['XA_OBS_RANGE'])  # this carves out the exponent...
+    out[off+38:off+45] = rgval.encode('ascii')
+    out[off+45:off+46] = rgexp.encode('ascii')
+    out[off+74:off+75] = b'2'
+
 def maketype2( data, datetm=None ):
     '''
     4 - Elevation, azimuth, range, range rate, elevation rate, azimuth rate, rate acceleration
@@ -163,17 +188,16 @@ def maketype2( data, datetm=None ):
 
     '''
     ts = makeCommon(data, datetm=datetm) 
-    ts[23:29] = makeEl( data['XA_OBS_ELORDEC'])
-    ts[30:37] = B3_float_field( data['XA_OBS_AZORRA'],3,4)
-    rgval, rgexp = makeRange(data['XA_OBS_RANGE'])  # this carves out the exponent...
-    ts[38:45] = rgval
-    ts[45]    = rgexp
-    ts[74] = '2'
-    #ts[75] = '0'
-    return ''.join(ts)
+    _write_type2( ts, 0, data )
+    return ts.decode('ascii')
 
 
 # ------------------------------------  TYPE 3 ---------------------------------------
+def _write_type3( out, off, data ):
+    _write_type2( out, off, data )
+    out[off+47:off+54] = B3_float_field( data['XA_OBS_RANGERATE'],2,5).encode('ascii')
+    out[off+74:off+75] = b'3'
+
 def maketype3( data, datetm=None ):
     '''
     4 - Elevation, azimuth, range, range rate, elevation rate, azimuth rate, rate acceleration
@@ -181,17 +205,17 @@ def maketype3( data, datetm=None ):
 
     '''
     ts = makeCommon(data, datetm=datetm) 
-    ts[23:29] = makeEl( data['XA_OBS_ELORDEC'])
-    ts[30:37] = B3_float_field( data['XA_OBS_AZORRA'],3,4)
-    rgval, rgexp = makeRange(data['XA_OBS_RANGE'])  # this carves out the exponent...
-    ts[38:45] = rgval
-    ts[45]    = rgexp
-    ts[47:54] = B3_float_field( data['XA_OBS_RANGERATE'],2,5)  
-    ts[74] = '3'
-    #ts[75] = '0'
-    return ''.join(ts)
+    _write_type3( ts, 0, data )
+    return ts.decode('ascii')
 
 # ------------------------------------  TYPE 4 ---------------------------------------
+def _write_type4( out, off, data ):
+    _write_type3( out, off, data )
+    out[off+55:off+60] = B3_float_field( data['XA_OBS_ELRATE'],1,4).encode('ascii')
+    out[off+61:off+66] = B3_float_field( data['XA_OBS_AZRATE'],1,4).encode('ascii')
+    out[off+67:off+72] = B3_float_field( data['XA_OBS_RANGEACCEL'],1,4).encode('ascii')
+    out[off+74:off+75] = b'4'
+
 def maketype4( data, datetm=None ):
     '''
     4 - Elevation, azimuth, range, range rate, elevation rate, azimuth rate, rate acceleration
@@ -199,61 +223,101 @@ def maketype4( data, datetm=None ):
 
     '''
     ts = makeCommon(data, datetm=datetm) 
-    ts[23:29] = makeEl( data['XA_OBS_ELORDEC'])
-    ts[30:37] = B3_float_field( data['XA_OBS_AZORRA'],3,4)
-    rgval, rgexp = makeRange(data['XA_OBS_RANGE'])  # this carves out the exponent...
-    ts[38:45] = rgval
-    ts[45]    = rgexp
-    ts[47:54] = B3_float_field( data['XA_OBS_RANGERATE'],2,5)  
-    ts[55:60] = B3_float_field( data['XA_OBS_ELRATE'],1,4) 
-    ts[61:66] = B3_float_field( data['XA_OBS_AZRATE'],1,4) 
-    ts[67:72] = B3_float_field( data['XA_OBS_RANGEACCEL'],1,4)
-    ts[74] = '4'
-    #ts[75] = '0'
-    return ''.join(ts)
+    _write_type4( ts, 0, data )
+    return ts.decode('ascii')
 
 # ------------------------------------  TYPE 5 ---------------------------------------
+def _write_type5( out, off, data ):
+    out[off+23:off+29] = B3_float_field( data['XA_OBS_ELORDEC'], 2, 4).encode('ascii')
+    out[off+30:off+37] = makeRA( data['XA_OBS_AZORRA']).encode('ascii')
+    out[off+74:off+75] = b'5'
+
 def maketype5( data, datetm=None ):
     ts = makeCommon( data, datetm=datetm )
-    ts[23:29] = B3_float_field( data['XA_OBS_ELORDEC'], 2, 4)
-    ts[30:37] = makeRA( data['XA_OBS_AZORRA'])
-    ts[74] = '5'
-    #ts[75] = '0'
-    return ''.join(ts)
+    _write_type5( ts, 0, data )
+    return ts.decode('ascii')
 
 # ------------------------------------  TYPE 6 ---------------------------------------
+def _write_type6( out, off, data ):
+    rgval, rgexp = makeRange(data['XA_OBS_RANGE'])  # this carves out the exponent...
+    out[off+38:off+45] = rgval.encode('ascii')
+    out[off+45:off+46] = rgexp.encode('ascii')
+    out[off+74:off+75] = b'6'
+
 def maketype6( data, datetm=None ):
     ts = makeCommon( data, datetm=datetm )
-    rgval, rgexp = makeRange(data['XA_OBS_RANGE'])  # this carves out the exponent...
-    ts[38:45] = rgval
-    ts[45]    = rgexp
-    ts[74] = '6'
-    #ts[75] = '0'
-    return ''.join(ts)
+    _write_type6( ts, 0, data )
+    return ts.decode('ascii')
 
 # ------------------------------------  TYPE 9 ---------------------------------------
+def _write_type9( out, off, data ):
+    out[off+23:off+29] = makeEl( data['XA_OBS_ELORDEC']).encode('ascii')
+    out[off+30:off+37] = makeRA( data['XA_OBS_AZORRA']).encode('ascii')
+    out[off+38:off+45] = b'0000000'
+    out[off+46:off+55] = fortran9p3( data['XA_OBS_POSX'] ).encode('ascii')
+    out[off+55:off+64] = fortran9p3( data['XA_OBS_POSY'] ).encode('ascii')
+    out[off+64:off+73] = fortran9p3( data['XA_OBS_POSZ'] ).encode('ascii')
+    out[off+74:off+75] = b'9'
+
 def maketype9( data, datetm=None ):
     ts = makeCommon( data, datetm=datetm )
-    ts[23:29] = makeEl( data['XA_OBS_ELORDEC'])
-    ts[30:37] = makeRA( data['XA_OBS_AZORRA'])
-    ts[38:45] = '0000000'
-    ts[46:55] = fortran9p3( data['XA_OBS_POSX'] ) 
-    ts[55:64] = fortran9p3( data['XA_OBS_POSY'] ) 
-    ts[64:73] = fortran9p3( data['XA_OBS_POSZ'] ) 
-    ts[74] = '9'
-    #ts[75] = '0'
-    return ''.join(ts)
+    _write_type9( ts, 0, data )
+    return ts.decode('ascii')
 
 # ------------------------------------ dispatcher ------------------------------------
+_DISPATCH = {1 : maketype1,
+             2 : maketype2,
+             3 : maketype3,
+             4 : maketype4,
+             5 : maketype5,
+             6 : maketype6,
+             9 : maketype9}
+
+_WRITERS = {1 : _write_type1,
+            2 : _write_type2,
+            3 : _write_type3,
+            4 : _write_type4,
+            5 : _write_type5,
+            6 : _write_type6,
+            9 : _write_type9}
+
 def b3_dispatcher( data, datetm=None, equinox=Equinox.TEME ):
     assert len(equinox) == 1
-    if data['XA_OBS_OBSTYPE'] == 1: return maketype1( data, datetm=datetm ) + equinox
-    if data['XA_OBS_OBSTYPE'] == 2: return maketype2( data, datetm=datetm ) + equinox
-    if data['XA_OBS_OBSTYPE'] == 3: return maketype3( data, datetm=datetm ) + equinox
-    if data['XA_OBS_OBSTYPE'] == 4: return maketype4( data, datetm=datetm ) + equinox
-    if data['XA_OBS_OBSTYPE'] == 5: return maketype5( data, datetm=datetm ) + equinox
-    if data['XA_OBS_OBSTYPE'] == 6: return maketype6( data, datetm=datetm ) + equinox
-    if data['XA_OBS_OBSTYPE'] == 9: return maketype9( data, datetm=datetm ) + equinox
+    fn = _DISPATCH.get( data['XA_OBS_OBSTYPE'] )
+    if fn: return fn( data, datetm=datetm ) + equinox
+
+def b3_dispatcher_batch( rows, equinox=Equinox.TEME, leapseconds=False ):
+    '''
+    b3_dispatcher over a list of astrostandards dicts, converting all the dates in one go
+    (see ds50ToDateTime_batch for leapseconds)
+    '''
+    datetms = ds50ToDateTime_batch( [ R['XA_OBS_DS50UTC'] for R in rows ], leapseconds=leapseconds )
+    return [ b3_dispatcher( R, datetm=D, equinox=equinox ) for R, D in zip( rows, datetms ) ]
+
+def write_all_b3( rows, out=None, newline=b'\n', equinox=Equinox.TEME, leapseconds=False ):
+    '''
+    bulk output into one preallocated buffer: each row is written in place at i * (76 + len(newline)),
+    so out.decode('ascii') is the whole file ('\n'.join of b3_dispatcher, plus a trailing newline).
+    out, if given, must be a bytearray of exactly len(rows) * (76 + len(newline)) bytes.
+    rows with an obstype we can't write are left as blank lines (see ds50ToDateTime_batch for leapseconds).
+    '''
+    assert len(equinox) == 1
+    width   = 76 + len(newline)
+    blank   = b' ' * 76 + newline
+    eq      = equinox.encode('ascii')
+    if out is None: out = bytearray( len(rows) * width )
+    if len(out) != len(rows) * width:
+        raise ValueError( 'write_all_b3: out is {} bytes, need exactly {}'.format( len(out), len(rows) * width ) )
+    datetms = ds50ToDateTime_batch( [ R['XA_OBS_DS50UTC'] for R in rows ], leapseconds=leapseconds )
+    for i, (R, D) in enumerate( zip( rows, datetms ) ):
+        off = i * width
+        out[off:off+width] = blank
+        fn = _WRITERS.get( R['XA_OBS_OBSTYPE'] )
+        if fn is None: continue
+        _write_common( out, off, R, datetm=D )
+        fn( out, off, R )
+        out[off+75:off+76] = eq
+    return out
 
 
 #=====================================================================================
@@ -1,7 +1,14 @@
-from pyb3 import B3
+import astropy.time
+import numpy as np
+import pytest
+from datetime import datetime, timedelta, timezone
+from pyb3 import B3, B3View, B3Batch
+from pyb3 import outputter, kernels
+from pyb3.B3 import as_fields, _datetime_to_ds50
 import pyb3
 
-B3s='''U2301324298022165241992019037 0633491                                     5 3  100000
+# test cards (test() rebinds B3s to the parsed objects, so the other tests use B3_CARDS)
+B3_CARDS='''U2301324298022165241992019037 0633491                                     5 3  100000
 U2301324298022165305313019171 0634118                                     5 4  100000
 U2301324298022165333660019112 0634391                                     5 4  100000
 U2301324298022165355724019139 0635005                                     5 4  100000
@@ -95,6 +102,11 @@ U2071295198155143805410095303 0035403                                     5 4  2
 U2071295198155143815441095381 0035503                                     5 4  200000
 U2071295198155143825328095461 0036003                                     5 4  200000
 U2071295198155143837270095557 0036123                                     5 5  200000'''
+B3s = B3_CARDS
+
+def padded_lines():
+    ''' the test cards, padded out to the full 80 columns '''
+    return [ l.ljust(80) for l in B3_CARDS.split('\n') ]
 
 # -----------------------------------------------------------------------------------------------------
 def test():
@@ -112,3 +124,109 @@ def test():
         print()
 
 
+
+# -----------------------------------------------------------------------------------------------------
+def test_parse_many():
+    lines = padded_lines()
+    views = B3View.from_lines( lines )
+    for l, V in zip( lines, views ):
+        B = B3( l )
+        for k, v in B.toAstrostdDict().items():
+            assert abs( v - V.toAstrostdDict()[k] ) < 1e-9, (k, l)
+        assert B.datetime == V.datetime
+        assert B.equinox  == V.equinox
+
+# -----------------------------------------------------------------------------------------------------
+def test_kernels():
+    lines = padded_lines()
+    obs   = [ B3(l).toAstrostdDict() for l in lines ]
+    soa   = { k : np.array( [ o[k] for o in obs ] ) for k in as_fields }
+    out   = kernels.write_b3_lines( soa ).tobytes().decode('ascii').split('\n')
+    for l, o in zip( lines, out ):
+        # sat/sensor, el/dec, az/ra and range all round trip
+        assert l[:9] == o[:9] and l[23:46] == o[23:46], (l, o)
+    # and the kernels write exactly what the per-line writers do
+    assert out[:-1] == outputter.b3_dispatcher_batch( obs )
+
+# -----------------------------------------------------------------------------------------------------
+def test_astro_std_array():
+    lines = padded_lines()
+    arr   = B3Batch.from_lines( lines ).toAstrostdArray()
+    for l, rec in zip( lines, arr ):
+        for k, v in B3( l ).toAstrostdDict().items():
+            assert abs( v - rec[k] ) < 1e-9, (k, l)
+    # a classification outside U/C/S is rejected by both exporters
+    bad = 'X' + lines[0][1:]
+    with pytest.raises( KeyError ): B3( bad ).toAstrostdDict()
+    with pytest.raises( KeyError ): B3Batch.from_lines( [ lines[0], bad ] ).toAstrostdArray()
+
+# -----------------------------------------------------------------------------------------------------
+def test_ecf_rates():
+    # type 9 carries the ECF position where the rates would be -- don't parse rates out of it
+    for l in padded_lines():
+        if l[74] != '9': continue
+        B = B3( l )
+        assert B.rngrate == 0.
+        assert B.elrate == B.azrate == B.rangeacc == B.default
+
+# -----------------------------------------------------------------------------------------------------
+def test_write_all_b3():
+    rows = [ B3( l ).toAstrostdDict() for l in padded_lines() ]
+    text = outputter.write_all_b3( rows, equinox=outputter.Equinox.J2K ).decode('ascii')
+    assert text.split('\n')[:-1] == outputter.b3_dispatcher_batch( rows, equinox=outputter.Equinox.J2K )
+    leap = outputter.write_all_b3( rows, leapseconds=True ).decode('ascii')
+    assert leap.split('\n')[:-1] == outputter.b3_dispatcher_batch( rows, leapseconds=True )
+    text = outputter.write_all_b3( rows ).decode('ascii')
+    # a reused buffer has to be exactly the right size
+    for n in ( len(text) - 1, len(text) + 1 ):
+        with pytest.raises( ValueError ): outputter.write_all_b3( rows, out=bytearray( n ) )
+    buf = bytearray( b'x' * len(text) )
+    assert outputter.write_all_b3( rows, out=buf ).decode('ascii') == text
+
+# -----------------------------------------------------------------------------------------------------
+def test_ds50_vs_astropy():
+    # none of these fall on a leap-second day (see _datetime_to_ds50)
+    dts = [ B3( l ).datetime for l in padded_lines() ]
+    dts += [ datetime(1950, 1, 1), datetime(1972, 3, 1, 12), datetime(2000, 2, 29, 23, 59, 59, 999000),
+             datetime(2016, 12, 30, 6, 30, 15, 250000), datetime(2024, 7, 4, 1, 2, 3) ]
+    for dt in dts:
+        assert abs( _datetime_to_ds50( dt ) - (astropy.time.Time( dt ).jd - B3.jd1950) ) < 1e-9, dt
+
+# -----------------------------------------------------------------------------------------------------
+def test_kernels_buffer_check():
+    obs = [ B3( l ).toAstrostdDict() for l in padded_lines() ]
+    soa = { k : np.array( [ o[k] for o in obs ] ) for k in as_fields }
+    big = np.zeros( 2 * len(obs) * kernels.LINE_LEN, dtype=np.uint8 )
+    # too small, strided, wrong dtype, not an array, oversized
+    for bad in ( big[:kernels.LINE_LEN], big[::2], big.astype( np.int64 ), bytearray( len(big) ), big ):
+        with pytest.raises( ValueError ): kernels.write_b3_lines( soa, out_buf=bad )
+    assert not big.any()
+    # an exactly sized, reused buffer comes back with nothing stale in it
+    buf = np.full( len(obs) * kernels.LINE_LEN, ord('x'), dtype=np.uint8 )
+    assert kernels.write_b3_lines( soa, out_buf=buf ).tobytes() == kernels.write_b3_lines( soa ).tobytes()
+
+# -----------------------------------------------------------------------------------------------------
+def test_makeDate():
+    for dt in ( datetime(2000, 12, 31, 23, 59, 59, 999999), datetime(2023, 3, 1, 4, 5, 6, 7000),
+                datetime(2023, 3, 1, 4, 5, 6, 7000, tzinfo=timezone.utc),
+                datetime(2024, 2, 29, 12, tzinfo=timezone(timedelta(hours=-5))) ):
+        assert outputter.makeDate( dt ) == dt.strftime('%y%j%H%M%S%f')[:14], dt
+
+# -----------------------------------------------------------------------------------------------------
+def test_ds50_batch_leapseconds():
+    # the last three fall on leap-second days (1983-06-30, 1994-06-30, 2012-06-30)
+    vals = [ B3( l ).toAstrostdDict()['XA_OBS_DS50UTC'] for l in padded_lines() ]
+    vals += [ 12234.740184105756, 16252.618231179018, 22827.364206729435 ]
+    dts = outputter.ds50ToDateTime_batch( vals, leapseconds=True )
+    assert list( dts ) == [ outputter.ds50ToATime( v ).datetime for v in vals ]
+
+# -----------------------------------------------------------------------------------------------------
+def test_non_ascii_tail():
+    # only the leading fields go through the ascii struct unpack
+    l = padded_lines()[0]
+    B = B3( l[:80] + 'é' )
+    assert B.satid == B3( l ).satid and B.site_tag is None
+    # same for the bulk parser, with the bad character inside and past the parsed columns
+    soa = B3.parse_many( [ l[:80] + 'é', l[:80] + ' ' * 20 + 'é', l ] )
+    assert list( soa['satid'] ) == [ B3( l ).satid ] * 3
+    assert np.isnan( soa['site_tag'][:2] ).all()
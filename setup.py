@@ -10,6 +10,6 @@ setup(name='PyB3',
         license='MIT',
         packages=['PyB3'],
         # you'll also need PyRSO (but that is also in GitHub)
-        install_requires=['astropy','datetime'],
+        install_requires=['astropy','datetime','numpy'],
         include_package_data=True,
         zip_safe=False)